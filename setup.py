@@ -31,6 +31,10 @@ REQUIRES = [
 # optional requirements
 ALL = [
     'dill',
+    'isal',
+    'rapidgzip',
+    # stream_writer(closefd=...) was added in 0.15
+    'zstandard>=0.15',
 ]
 
 # only needed for development
@@ -21,14 +21,23 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 import builtins
-from contextlib import contextmanager
+from contextlib import contextmanager, suppress
 from pathlib import Path
+import functools
+import importlib
+import io
+import operator
 import os
 import sys
 import pdb
-import gzip
+import shutil
+import tempfile
+import threading
+import types
 import linecache
+import tokenize
 from traceback import format_exception
+from datetime import date, time, datetime, timedelta
 try:
     import cPickle as pickle
 except ImportError:
@@ -44,7 +53,48 @@ try:
 except ImportError:
     dill = None
 
-DUMP_VERSION = 1
+# isa-l's gzip implementation is a drop-in replacement, several times faster
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+# decompresses gzip dumps in parallel
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+# compresses better and faster than gzip, if installed, new dumps use it
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DUMP_VERSION = 2
+
+# marks dumps that start with out-of-band buffers
+_OUT_OF_BAND = "debuglater-out-of-band-buffers"
+
+# pickle issues many small reads and writes, buffering them avoids calling
+# the compressor for every one of them
+_BUFFER_SIZE = 128 * 1024
+
+# dumps up to this size are serialized in memory
+_SPOOL_MAX_SIZE = 32 * 1024 * 1024
+
+# parallel decompression only pays off for large dumps
+_PARALLEL_MIN_SIZE = 16 * 1024 * 1024
+
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+_ZSTD_LEVEL = 3
+
+# compresses nearly as much as the default but is much faster (isa-l only
+# supports levels 0 to 3)
+_COMPRESS_LEVEL = 2 if gzip.__name__ == "isal.igzip" else 6
 
 
 def _print_not_dill():
@@ -52,6 +102,276 @@ def _print_not_dill():
           "To serialize everything: pip install 'debuglater[all]'\n")
 
 
+class _Pickler(pickle.Pickler):
+    """
+    A pickler that serializes modules by name and refuses to serialize
+    classes and functions defined in __main__: pickle stores them by
+    reference, which can't be resolved when loading the dump, so we let dill
+    serialize them by value instead
+    """
+
+    def reducer_override(self, obj):
+        if isinstance(obj, types.ModuleType):
+            if obj.__name__ == "__main__":
+                raise pickle.PicklingError("can't pickle __main__ by name")
+
+            return importlib.import_module, (obj.__name__, )
+
+        if (isinstance(obj, (type, types.FunctionType))
+                and getattr(obj, "__module__", None) == "__main__"):
+            raise pickle.PicklingError(
+                "can't pickle %r defined in __main__ by reference" % obj)
+
+        return NotImplemented
+
+
+# reducer_override was added in Python 3.8, before that we can't guarantee
+# that objects pickled by reference will load, so we always use dill
+_FAST_PICKLE = sys.version_info >= (3, 8)
+
+_PICKLE_ERRORS = (pickle.PicklingError, TypeError, AttributeError)
+
+
+def _pickle_dump(obj, f, buffer_callback=None):
+    _Pickler(f, protocol=pickle.HIGHEST_PROTOCOL,
+             buffer_callback=buffer_callback).dump(obj)
+
+
+def _skip_buffer(buffer):
+    # returning a false value keeps the buffer out of the pickle stream, so
+    # checking if large arrays are picklable doesn't copy their data
+    return False
+
+
+class _DillValues(object):
+    """
+    Collects the objects that only dill can serialize so the rest of the dump
+    can be written with pickle. They're serialized together, in a single dill
+    payload, so they keep sharing objects (e.g., two instances of a class
+    defined in __main__ load with the same class)
+    """
+
+    def __init__(self):
+        self.values = []
+        self.payload = None
+
+    def add(self, v):
+        self.values.append(v)
+        return _DillRef(self, len(self.values) - 1)
+
+    def seal(self):
+        """
+        Serializes the values, call it once all of them have been collected
+        """
+        self.payload = dill.dumps(self.values)
+
+    def __reduce__(self):
+        # dill may reach this object before it's sealed (e.g., when it
+        # serializes this module by value while checking another object)
+        if self.payload is None:
+            return _DillValues, ()
+
+        return dill.loads, (self.payload, )
+
+
+class _DillRef(object):
+    """
+    Stands for a value in _DillValues, loads as the value itself
+    """
+
+    def __init__(self, values, index):
+        self.values = values
+        self.index = index
+
+    def __reduce__(self):
+        return operator.getitem, (self.values, self.index)
+
+
+class _DumpState(object):
+    """
+    What save_dump keeps while converting a traceback. Each call creates its
+    own, so dumps can be saved from several threads at once
+    """
+
+    def __init__(self):
+        self.dill_values = _DillValues()
+        # maps id(v) to (v, converted v), so objects shared between frames
+        # (modules, classes, etc.) are only serialized once to check if
+        # they're picklable. Keeping a reference to v prevents its id from
+        # being reused
+        self.converted = {}
+        # maps id(globals) to (globals, converted globals), so frames from
+        # the same module share their globals, like real frames do
+        self.converted_globals = {}
+
+
+def _is_picklable(v):
+    try:
+        _pickle_dump(v, io.BytesIO(), buffer_callback=_skip_buffer)
+        return True
+    except Exception:
+        return False
+
+
+def _pickle_or_dill(v, state):
+    """
+    Returns v if pickle can serialize it, otherwise adds it to the values
+    serialized with dill and returns a reference to it. Raises an exception
+    if neither can serialize it
+    """
+    if not _FAST_PICKLE:
+        dill.dumps(v)
+        return v
+
+    if _is_picklable(v):
+        return v
+
+    dill.dumps(v)
+    return state.dill_values.add(v)
+
+
+def _compressor(filename, raw):
+    if zstandard is not None:
+        # threads=-1 compresses using all CPUs
+        compressor = zstandard.ZstdCompressor(level=_ZSTD_LEVEL, threads=-1)
+        # io.BufferedWriter needs write() to return the number of bytes
+        # consumed, older versions of zstandard return the bytes written
+        return compressor.stream_writer(raw,
+                                        closefd=False,
+                                        write_return_read=True)
+
+    # pass the final name so it's the one stored in the gzip header
+    return gzip.GzipFile(filename,
+                         "wb",
+                         compresslevel=_COMPRESS_LEVEL,
+                         fileobj=raw)
+
+
+@contextmanager
+def _open_for_writing(filename):
+    """
+    Writes to a temporary file next to filename and moves it into place when
+    done, so a crash while writing doesn't leave a truncated dump behind.
+    The temporary file's name is unique to the thread, so several threads can
+    save the same dump at once
+    """
+    filename = os.fspath(filename)
+    tmp = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.get_ident())
+
+    try:
+        with open(tmp, "wb") as raw, \
+                _compressor(filename, raw) as compressed, \
+                io.BufferedWriter(compressed, buffer_size=_BUFFER_SIZE) as f:
+            yield f
+    except BaseException:
+        with suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+    os.replace(tmp, filename)
+
+
+def _decompressor(filename):
+    with open(filename, "rb") as f:
+        magic = f.read(len(_ZSTD_MAGIC))
+
+    if magic == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise ImportError(f"{filename} is compressed with zstandard, "
+                              "to load it: pip install zstandard")
+
+        decompressor = zstandard.ZstdDecompressor()
+        return decompressor.stream_reader(open(filename, "rb"))
+
+    # rapidgzip only checks the format when reading, so check it here to
+    # keep the fallback for dumps that aren't compressed
+    if (rapidgzip is not None and magic.startswith(_GZIP_MAGIC)
+            and os.path.getsize(filename) >= _PARALLEL_MIN_SIZE):
+        return rapidgzip.open(os.fspath(filename),
+                              parallelization=os.cpu_count())
+
+    return gzip.open(filename, "rb")
+
+
+@contextmanager
+def _open_for_reading(filename):
+    with _decompressor(filename) as decompressed, \
+            io.BufferedReader(decompressed, buffer_size=_BUFFER_SIZE) as f:
+        yield f
+
+
+def _serialize(dump, dir=None):
+    """
+    Serializes the dump before writing it, since its out-of-band buffers
+    (e.g., the data of numpy arrays) must be written first. Those are
+    written as they are instead of being copied into the pickle stream.
+    Returns a file with the pickled data and the list of buffers
+
+    Small dumps are kept in memory, larger ones are written to a temporary
+    file in dir, so saving a dump (e.g., after a MemoryError) doesn't double
+    the memory used
+    """
+    data = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE, dir=dir)
+    buffers = []
+
+    try:
+        if dill is None:
+            pickle.dump(dump, data, protocol=pickle.HIGHEST_PROTOCOL)
+            return data, buffers
+
+        if _FAST_PICKLE:
+            # pickle is much faster than dill, objects that only dill can
+            # serialize were already collected by _convert
+            try:
+                _pickle_dump(dump, data, buffer_callback=buffers.append)
+                return data, buffers
+            except _PICKLE_ERRORS:
+                data.seek(0)
+                data.truncate()
+                buffers = []
+
+        dill.dump(dump, data)
+        return data, buffers
+    except BaseException:
+        data.close()
+        raise
+
+
+def _write(f, data, buffers):
+    # out-of-band buffers go first, preceded by their sizes, so they're
+    # available when unpickling the data
+    if buffers:
+        raws = [b.raw() for b in buffers]
+        pickle.dump((_OUT_OF_BAND, [raw.nbytes for raw in raws]), f)
+
+        for raw in raws:
+            f.write(raw)
+
+    data.seek(0)
+    shutil.copyfileobj(data, f, _BUFFER_SIZE)
+
+
+def _load(f, load):
+    dump = load(f)
+
+    if isinstance(dump, tuple) and dump[0] == _OUT_OF_BAND:
+        buffers = []
+
+        for size in dump[1]:
+            # bytearray so the objects using them (e.g., numpy arrays) are
+            # writable
+            buffer = bytearray(size)
+
+            if f.readinto(buffer) != size:
+                raise EOFError("dump ended before all its buffers were read")
+
+            buffers.append(buffer)
+
+        dump = load(f, buffers=buffers)
+
+    return dump
+
+
 def save_dump(filename, tb=None):
     """
     Saves a Python traceback in a pickled file. This function will usually be
@@ -63,21 +383,37 @@ def save_dump(filename, tb=None):
     """
     if not tb:
         tb = sys.exc_info()[2]
-    fake_tb = FakeTraceback(tb)
-    _remove_builtins(fake_tb)
+
+    state = _DumpState()
+
+    # relative paths depend on the working directory, which may have changed
+    # since the last dump
+    _abspath.cache_clear()
+
+    fake_tb = FakeTraceback.from_chain(tb, state)
+
+    if state.dill_values.values:
+        state.dill_values.seal()
 
     dump = {
+        # frames and tracebacks point to each other in long chains,
+        # listing them so each one comes after the ones it points to
+        # keeps pickle from recursing down the chains
+        "frames": list(_iter_frames(fake_tb)),
+        "tracebacks": list(_iter_tracebacks(fake_tb))[::-1],
         "traceback": fake_tb,
         "files": _get_traceback_files(fake_tb),
         "dump_version": DUMP_VERSION,
     }
 
-    with gzip.open(filename, "wb") as f:
-        if dill is not None:
-            dill.dump(dump, f)
-        else:
-            _print_not_dill()
-            pickle.dump(dump, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if dill is None:
+        _print_not_dill()
+
+    data, buffers = _serialize(dump,
+                               os.path.dirname(os.path.abspath(filename)))
+
+    with data, _open_for_writing(filename) as f:
+        _write(f, data, buffers)
 
 
 def load_dump(filename):
@@ -85,50 +421,61 @@ def load_dump(filename):
     # ugly hack to handle running non-install debuglater
     if "debuglater.pydump" not in sys.modules:
         sys.modules["debuglater.pydump"] = sys.modules[__name__]
-    with gzip.open(filename, "rb") as f:
+    with _open_for_reading(filename) as f:
         if dill is not None:
             try:
-                return dill.load(f)
+                return _load(f, dill.load)
             except IOError:
                 try:
                     with open(filename, "rb") as f:
-                        return dill.load(f)
+                        return _load(f, dill.load)
                 except Exception:
                     pass  # dill load failed, try pickle instead
         else:
             _print_not_dill()
 
         try:
-            return pickle.load(f)
+            return _load(f, pickle.load)
         except IOError:
             with open(filename, "rb") as f:
-                return pickle.load(f)
+                return _load(f, pickle.load)
 
 
 def debug_dump(dump_filename, post_mortem_func=pdb.post_mortem):
-    # monkey patching for pdb's longlist command
-    import inspect
-    import types
-
-    inspect.isframe = lambda obj: isinstance(
-        obj, types.FrameType) or obj.__class__.__name__ == "FakeFrame"
-    inspect.iscode = lambda obj: isinstance(
-        obj, types.CodeType) or obj.__class__.__name__ == "FakeCode"
-    inspect.isclass = lambda obj: isinstance(
-        obj, type) or obj.__class__.__name__ == "FakeClass"
-    inspect.istraceback = lambda obj: isinstance(
-        obj, types.TracebackType) or obj.__class__.__name__ == "FakeTraceback"
-
     with add_to_sys_path('.', chdir=False):
         dump = load_dump(dump_filename)
 
     _cache_files(dump["files"])
     tb = dump["traceback"]
     _inject_builtins(tb)
-    _old_checkcache = linecache.checkcache
+
+    with _patch_for_fake_objects():
+        post_mortem_func(tb)
+
+
+@contextmanager
+def _patch_for_fake_objects():
+    """
+    Makes inspect recognize the fake objects (for pdb's longlist command) and
+    keeps linecache from discarding the source files stored in the dump
+    """
+    import inspect
+
+    originals = (inspect.isframe, inspect.iscode, inspect.isclass,
+                 inspect.istraceback, linecache.checkcache)
+
+    inspect.isframe = lambda obj: isinstance(obj, (types.FrameType, FakeFrame))
+    inspect.iscode = lambda obj: isinstance(obj, (types.CodeType, FakeCode))
+    inspect.isclass = lambda obj: isinstance(obj, (type, FakeClass))
+    inspect.istraceback = lambda obj: isinstance(
+        obj, (types.TracebackType, FakeTraceback))
     linecache.checkcache = lambda filename=None: None
-    post_mortem_func(tb)
-    linecache.checkcache = _old_checkcache
+
+    try:
+        yield
+    finally:
+        (inspect.isframe, inspect.iscode, inspect.isclass,
+         inspect.istraceback, linecache.checkcache) = originals
 
 
 class FakeClass(object):
@@ -141,10 +488,17 @@ class FakeClass(object):
         return self.__repr
 
 
+@functools.lru_cache(maxsize=4096)
+def _abspath(path):
+    # code objects in the same file share the path, this saves calling
+    # os.getcwd for every one of them. save_dump clears the cache
+    return os.path.abspath(path)
+
+
 class FakeCode(object):
 
     def __init__(self, code):
-        self.co_filename = os.path.abspath(code.co_filename)
+        self.co_filename = _abspath(code.co_filename)
         self.co_name = code.co_name
         self.co_argcount = code.co_argcount
         self.co_consts = tuple(
@@ -158,77 +512,207 @@ class FakeCode(object):
 
         # co_lines was introduced in a recent version
         if hasattr(code, 'co_lines'):
-            self.co_lines = FakeCoLines(code.co_lines)
+            self.co_lines = FakeCoLines(code)
 
 
 class FakeCoLines:
+    """
+    Stores the (compact) line table of a code object and decodes it when
+    co_lines() is called, instead of storing one tuple per entry for every
+    code object in the dump
+    """
 
-    def __init__(self, co_lines) -> None:
-        self._co_lines = list(co_lines())
+    def __init__(self, code) -> None:
+        self._co_code = code.co_code
+        self._co_linetable = code.co_linetable
+        self._co_firstlineno = code.co_firstlineno
+        self._version = sys.version_info[:2]
 
     def __call__(self):
-        return iter(self._co_lines)
+        # dumps created by older versions store the decoded entries
+        if '_co_lines' in self.__dict__:
+            return iter(self._co_lines)
+
+        # the line table format changes between Python versions
+        if self._version != sys.version_info[:2]:
+            return iter(())
+
+        try:
+            code = _CODE_TEMPLATE.replace(
+                co_code=self._co_code,
+                co_linetable=self._co_linetable,
+                co_firstlineno=self._co_firstlineno)
+        except Exception:
+            return iter(())
+
+        return code.co_lines()
+
+
+# a code object to decode line tables with
+_CODE_TEMPLATE = (lambda: None).__code__
 
 
 class FakeFrame(object):
 
-    def __init__(self, frame):
+    def __init__(self, frame, state):
         self.f_code = FakeCode(frame.f_code)
-        self.f_locals = _convert_dict(frame.f_locals)
-        self.f_globals = _convert_dict(frame.f_globals)
+        self.f_locals = _convert_dict(frame.f_locals, state)
+        self.f_globals = _convert_globals(frame.f_globals, state)
         self.f_lineno = frame.f_lineno
-        self.f_back = FakeFrame(frame.f_back) if frame.f_back else None
+        self.f_back = None
 
+        # f_locals may be shared with other frames, so copy it
         if "self" in self.f_locals:
-            self.f_locals["self"] = _convert_obj(frame.f_locals["self"])
+            self.f_locals = {
+                **self.f_locals,
+                "self": _convert_obj(frame.f_locals["self"], state),
+            }
+
+    @classmethod
+    def from_chain(cls, frame, state, converted=None):
+        """
+        Converts a frame and the frames that called it (f_back). Frames in
+        converted (a dictionary mapping id(frame) to its FakeFrame) are
+        reused, and the new ones are added to it
+        """
+        if converted is None:
+            converted = {}
+
+        fake_frames = []
+
+        while frame is not None and id(frame) not in converted:
+            fake_frame = cls(frame, state)
+            converted[id(frame)] = fake_frame
+            fake_frames.append(fake_frame)
+            frame = frame.f_back
+
+        last = None if frame is None else converted[id(frame)]
+
+        for fake_frame, f_back in zip(fake_frames, fake_frames[1:] + [last]):
+            fake_frame.f_back = f_back
+
+        return fake_frames[0] if fake_frames else last
 
 
 class FakeTraceback(object):
 
-    def __init__(self, traceback):
-        self.tb_frame = FakeFrame(traceback.tb_frame)
+    def __init__(self, traceback, state, converted=None):
+        self.tb_frame = FakeFrame.from_chain(traceback.tb_frame, state,
+                                             converted)
         self.tb_lineno = traceback.tb_lineno
-        self.tb_next = FakeTraceback(
-            traceback.tb_next) if traceback.tb_next else None
+        self.tb_next = None
         self.tb_lasti = 0
 
+    @classmethod
+    def from_chain(cls, traceback, state):
+        """
+        Converts a traceback and the ones that follow it (tb_next), frames
+        shared between them are converted once
+        """
+        converted = {}
+        fake_tbs = []
+
+        while traceback is not None:
+            fake_tbs.append(cls(traceback, state, converted))
+            traceback = traceback.tb_next
+
+        for fake_tb, tb_next in zip(fake_tbs, fake_tbs[1:]):
+            fake_tb.tb_next = tb_next
 
-def _remove_builtins(fake_tb):
+        return fake_tbs[0] if fake_tbs else None
+
+
+def _iter_tracebacks(fake_tb):
     traceback = fake_tb
     while traceback:
-        frame = traceback.tb_frame
-        while frame:
-            frame.f_globals = dict((k, v) for k, v in frame.f_globals.items()
-                                   if k not in dir(builtins))
-            frame = frame.f_back
+        yield traceback
         traceback = traceback.tb_next
 
 
-def _inject_builtins(fake_tb):
-    traceback = fake_tb
-    while traceback:
+def _iter_frames(fake_tb):
+    """
+    Yields every frame in the traceback once, each one after the frame that
+    called it
+    """
+    seen = set()
+
+    for traceback in _iter_tracebacks(fake_tb):
+        new = []
         frame = traceback.tb_frame
-        while frame:
-            frame.f_globals.update(builtins.__dict__)
+
+        while frame and id(frame) not in seen:
+            seen.add(id(frame))
+            new.append(frame)
             frame = frame.f_back
-        traceback = traceback.tb_next
+
+        yield from reversed(new)
+
+
+_BUILTIN_NAMES = frozenset(vars(builtins))
+
+
+def _convert_globals(v, state):
+    cached = state.converted_globals.get(id(v))
+
+    if cached is None:
+        # builtins are injected back when loading the dump
+        without_builtins = {
+            k: i
+            for k, i in v.items() if k not in _BUILTIN_NAMES
+        }
+        cached = (v, _convert_dict(without_builtins, state))
+        state.converted_globals[id(v)] = cached
+
+    return cached[1]
+
+
+def _inject_builtins(fake_tb):
+    # maps id(globals) to (globals, globals with builtins)
+    injected = {}
+
+    for frame in _iter_frames(fake_tb):
+        key = id(frame.f_globals)
+
+        if key not in injected:
+            injected[key] = (frame.f_globals, {
+                **builtins.__dict__,
+                **frame.f_globals
+            })
+
+        frame.f_globals = injected[key][1]
+
+
+# maps a file's absolute path to ((mtime, size), source) so repeated dumps in
+# the same process (e.g., in a Jupyter session) only read files that changed
+_source_cache = {}
+
+
+def _read_source(filename):
+    stat = os.stat(filename)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _source_cache.get(filename)
+
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    # tokenize.open honors the encoding declared in the file (PEP 263)
+    with tokenize.open(filename) as f:
+        source = f.read()
+
+    _source_cache[filename] = (key, source)
+    return source
 
 
 def _get_traceback_files(traceback):
     files = {}
-    while traceback:
-        frame = traceback.tb_frame
-        while frame:
-            filename = os.path.abspath(frame.f_code.co_filename)
-            if filename not in files:
-                try:
-                    files[filename] = open(filename).read()
-                except IOError:
-                    files[filename] = ("couldn't locate '%s' "
-                                       "during dump" %
-                                       frame.f_code.co_filename)
-            frame = frame.f_back
-        traceback = traceback.tb_next
+    for frame in _iter_frames(traceback):
+        filename = _abspath(frame.f_code.co_filename)
+        if filename not in files:
+            try:
+                files[filename] = _read_source(filename)
+            except (OSError, SyntaxError, ValueError):
+                files[filename] = ("couldn't locate '%s' "
+                                   "during dump" % frame.f_code.co_filename)
     return files
 
 
@@ -239,58 +723,120 @@ def _safe_repr(v):
         return "repr error: " + str(e)
 
 
-def _convert_obj(obj):
+def _convert_obj(obj, state):
     try:
-        return FakeClass(_safe_repr(obj), _convert_dict(obj.__dict__))
+        return FakeClass(_safe_repr(obj), _convert_dict(obj.__dict__, state))
     except Exception:
-        return _convert(obj)
+        return _convert(obj, state)
 
 
-def _convert_dict(v):
-    return dict((_convert(k), _convert(i)) for (k, i) in v.items())
+def _convert_items(v, state):
+    return dict(
+        (_convert(k, state), _convert(i, state)) for (k, i) in v.items())
 
 
-def _convert_seq(v):
-    return (_convert(i) for i in v)
+def _convert_dict(v, state):
+    if dill is None:
+        return _convert_items(v, state)
 
+    cached = state.converted.get(id(v))
 
-def _convert(v):
-    if dill is not None:
-        try:
-            dill.dumps(v)
-            return v
-        except Exception:
-            return _safe_repr(v)
+    if cached is not None and isinstance(cached[1], dict):
+        return cached[1]
+
+    # most dictionaries (e.g., a frame's locals) can be pickled as a whole,
+    # which is much faster than checking each item
+    if _FAST_PICKLE and _is_picklable(v):
+        converted = dict(v)
     else:
-        from datetime import date, time, datetime, timedelta
+        converted = _convert_items(v, state)
 
-        BUILTIN = (str, int, float, date, time, datetime, timedelta)
-        # XXX: what about bytes and bytearray?
+    state.converted[id(v)] = (v, converted)
+    return converted
 
-        if v is None:
-            return v
 
-        if type(v) in BUILTIN:
-            return v
+def _only_builtins(v):
+    # containers holding only built-in values don't need to be converted
+    return all(type(i) in _LEAF_TYPES for i in v)
+
+
+def _convert_tuple(v, state):
+    return v if _only_builtins(v) else tuple([_convert(i, state) for i in v])
+
+
+def _convert_list(v, state):
+    return v if _only_builtins(v) else [_convert(i, state) for i in v]
+
+
+def _convert_set(v, state):
+    return v if _only_builtins(v) else {_convert(i, state) for i in v}
+
 
-        if type(v) is tuple:
-            return tuple(_convert_seq(v))
+def _identity(v, state):
+    return v
 
-        if type(v) is list:
-            return list(_convert_seq(v))
 
-        if type(v) is set:
-            return set(_convert_seq(v))
+# built-in types that are kept as they are
+_LEAF_TYPES = frozenset({
+    str,
+    int,
+    float,
+    bool,
+    bytes,
+    bytearray,
+    type(None),
+    date,
+    time,
+    datetime,
+    timedelta,
+})
 
-        if type(v) is dict:
-            return _convert_dict(v)
+# how to convert each type when dill isn't installed, anything else is
+# replaced by its repr
+_CONVERTERS = dict.fromkeys(_LEAF_TYPES, _identity)
+_CONVERTERS.update({
+    tuple: _convert_tuple,
+    list: _convert_list,
+    set: _convert_set,
+    dict: _convert_dict,
+})
 
-        return _safe_repr(v)
+
+def _convert(v, state):
+    if v is None or v is True or v is False:
+        return v
+
+    if dill is not None:
+        # modules are serialized by name (except __main__), so they don't
+        # need to be checked. Frame globals are mostly imports
+        if isinstance(v, types.ModuleType) and v.__name__ != "__main__":
+            return v
+
+        cached = state.converted.get(id(v))
+
+        if cached is not None:
+            return cached[1]
+
+        try:
+            converted = _pickle_or_dill(v, state)
+        except Exception:
+            converted = _safe_repr(v)
+
+        state.converted[id(v)] = (v, converted)
+        return converted
+    else:
+        converter = _CONVERTERS.get(type(v))
+        return _safe_repr(v) if converter is None else converter(v, state)
 
 
 def _cache_files(files):
     for name, data in files.items():
-        lines = [line + "\n" for line in data.splitlines()]
+        lines = data.splitlines(keepends=True)
+
+        # linecache expects every line to end with a newline
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+
         linecache.cache[name] = (len(data), None, lines, name)
 
 
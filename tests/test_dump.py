@@ -72,6 +72,28 @@ def test_dump(capsys, monkeypatch):
     assert 'x is 1' in out
 
 
+def test_debug_dump_restores_patched_functions(monkeypatch):
+    import inspect
+    import linecache
+
+    isframe, checkcache = inspect.isframe, linecache.checkcache
+
+    try:
+        foo()
+    except Exception:
+        filename = __file__ + '.dump'
+        pydump.run(filename, echo=False)
+
+    mock = Mock(side_effect=['longlist', 'quit'])
+
+    with monkeypatch.context() as m:
+        m.setattr('builtins.input', mock)
+        pydump.debug_dump(filename)
+
+    assert inspect.isframe is isframe
+    assert linecache.checkcache is checkcache
+
+
 def test_excepthook(capsys, monkeypatch):
     if Path('examples.crash.dump').is_file():
         Path('examples.crash.dump').unlink()
@@ -1,4 +1,13 @@
+import os
+import pickle
+import subprocess
 import sys
+import threading
+from pathlib import Path
+
+import dill
+import numpy as np
+import pytest
 
 from debuglater import pydump
 
@@ -7,9 +16,413 @@ def test_save_dump_without_dill(tmp_empty, monkeypatch):
     # simulate dill is not installed
     monkeypatch.setattr(pydump, 'dill', None)
 
+    def fn():
+        data = b'data'  # noqa
+        flag = True  # noqa
+        1 / 0
+
+    try:
+        fn()
+    except Exception:
+        tb = sys.exc_info()[2]
+
+    pydump.save_dump('name.dump', tb=tb)
+    dump = pydump.load_dump('name.dump')
+
+    f_locals = dump['traceback'].tb_next.tb_frame.f_locals
+    assert f_locals['data'] == b'data'
+    assert f_locals['flag'] is True
+
+
+def test_save_dump_with_objects_only_dill_can_serialize(tmp_empty):
+
+    def fn():
+        square = lambda x: x * x  # noqa
+        1 / 0
+
+    try:
+        fn()
+    except Exception:
+        tb = sys.exc_info()[2]
+
+    pydump.save_dump('name.dump', tb=tb)
+    dump = pydump.load_dump('name.dump')
+
+    square = dump['traceback'].tb_next.tb_frame.f_locals['square']
+    assert square(3) == 9
+
+
+def test_save_dump_keeps_identity_of_objects_only_dill_can_serialize(
+        tmp_empty):
+    Path('script.py').write_text("""
+from debuglater import pydump
+
+
+class Point:
+
+    def norm(self):
+        return 1
+
+
+def fn():
+    a = Point()
+    b = Point()
+    method = a.norm
+    1 / 0
+
+
+try:
+    fn()
+except Exception:
+    pydump.save_dump('script.dump')
+""")
+    subprocess.run([sys.executable, 'script.py'], check=True)
+
+    dump = pydump.load_dump('script.dump')
+    f_locals = dump['traceback'].tb_next.tb_frame.f_locals
+
+    assert type(f_locals['a']) is type(f_locals['b'])
+    assert f_locals['method'].__self__ is f_locals['a']
+
+
+def test_save_dump_deep_traceback(tmp_empty):
+
+    def recurse(n):
+        if n == 0:
+            1 / 0
+
+        recurse(n - 1)
+
+    try:
+        recurse(500)
+    except Exception:
+        tb = sys.exc_info()[2]
+
+    pydump.save_dump('name.dump', tb=tb)
+    dump = pydump.load_dump('name.dump')
+
+    traceback = dump['traceback']
+    while traceback.tb_next:
+        traceback = traceback.tb_next
+
+    assert traceback.tb_frame.f_locals['n'] == 0
+    assert traceback.tb_frame.f_back.f_locals['n'] == 1
+
+
+def test_save_dump_reads_files_again_if_they_change(tmp_empty):
+    Path('changing.py').write_text('def fn():\n    1 / 0\n')
+    sys.path.insert(0, tmp_empty)
+
+    try:
+        from changing import fn
+    finally:
+        sys.path.remove(tmp_empty)
+
     try:
+        fn()
+    except Exception:
+        tb = sys.exc_info()[2]
+
+    pydump.save_dump('first.dump', tb=tb)
+    Path('changing.py').write_text('def fn():\n    raise ValueError\n')
+    pydump.save_dump('second.dump', tb=tb)
+
+    path = str(Path('changing.py').resolve())
+    first = pydump.load_dump('first.dump')['files'][path]
+    second = pydump.load_dump('second.dump')['files'][path]
+
+    assert first == 'def fn():\n    1 / 0\n'
+    assert second == 'def fn():\n    raise ValueError\n'
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8),
+                    reason='requires pickle protocol 5')
+def test_save_dump_with_large_arrays(tmp_empty):
+
+    def fn():
+        x = np.arange(1_000_000)  # noqa
         1 / 0
+
+    try:
+        fn()
     except Exception:
         tb = sys.exc_info()[2]
 
     pydump.save_dump('name.dump', tb=tb)
+
+    # the array's data is written out-of-band, before the pickled data
+    with pydump._open_for_reading('name.dump') as f:
+        marker, sizes = pickle.load(f)
+
+    assert marker == pydump._OUT_OF_BAND
+    assert sizes == [np.arange(1_000_000).nbytes]
+
+    dump = pydump.load_dump('name.dump')
+
+    x = dump['traceback'].tb_next.tb_frame.f_locals['x']
+    np.testing.assert_array_equal(x, np.arange(1_000_000))
+    assert x.flags.writeable
+
+
+def test_load_dump_with_missing_buffers(tmp_empty):
+    with pydump._open_for_writing('name.dump') as f:
+        pickle.dump((pydump._OUT_OF_BAND, [100]), f)
+        f.write(b'x' * 10)
+
+    with pytest.raises(EOFError):
+        pydump.load_dump('name.dump')
+
+
+def test_save_dump_keeps_previous_dump_if_writing_fails(
+        tmp_empty, monkeypatch):
+    try:
+        1 / 0
+    except Exception:
+        tb = sys.exc_info()[2]
+
+    pydump.save_dump('name.dump', tb=tb)
+
+    def _write(f, data, buffers):
+        f.write(data.read(10))
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(pydump, '_write', _write)
+
+    with pytest.raises(KeyboardInterrupt):
+        pydump.save_dump('name.dump', tb=tb)
+
+    assert pydump.load_dump('name.dump')['traceback']
+    assert os.listdir() == ['name.dump']
+
+
+def test_load_gzip_dump(tmp_empty, monkeypatch):
+    try:
+        1 / 0
+    except Exception:
+        tb = sys.exc_info()[2]
+
+    with monkeypatch.context() as m:
+        m.setattr(pydump, 'zstandard', None)
+        pydump.save_dump('name.dump', tb=tb)
+
+    assert Path('name.dump').read_bytes()[:2] == b'\x1f\x8b'
+    assert pydump.load_dump('name.dump')['traceback']
+
+
+@pytest.mark.skipif(sys.version_info < (3, 10), reason='requires co_lines')
+def test_save_dump_co_lines(tmp_empty):
+
+    def fn():
+        for i in range(3):
+            i += 1
+
+        1 / 0
+
+    try:
+        fn()
+    except Exception:
+        tb = sys.exc_info()[2]
+
+    pydump.save_dump('name.dump', tb=tb)
+    dump = pydump.load_dump('name.dump')
+
+    code = dump['traceback'].tb_next.tb_frame.f_code
+    assert list(code.co_lines()) == list(fn.__code__.co_lines())
+
+
+def test_save_dump_shares_globals_between_frames(tmp_empty):
+
+    def recurse(n):
+        if n == 0:
+            1 / 0
+
+        recurse(n - 1)
+
+    try:
+        recurse(3)
+    except Exception:
+        tb = sys.exc_info()[2]
+
+    pydump.save_dump('name.dump', tb=tb)
+    dump = pydump.load_dump('name.dump')
+
+    first = dump['traceback'].tb_next.tb_frame
+    last = dump['traceback'].tb_next.tb_next.tb_next.tb_frame
+
+    assert first.f_globals is last.f_globals
+    assert 'pydump' in first.f_globals
+    assert 'print' not in first.f_globals
+
+
+@pytest.mark.parametrize('zstandard', [True, False])
+def test_load_large_dump(tmp_empty, monkeypatch, zstandard):
+    # every dump counts as large, so gzip dumps use rapidgzip if installed
+    monkeypatch.setattr(pydump, '_PARALLEL_MIN_SIZE', 0)
+
+    if not zstandard:
+        monkeypatch.setattr(pydump, 'zstandard', None)
+
+    try:
+        1 / 0
+    except Exception:
+        tb = sys.exc_info()[2]
+
+    pydump.save_dump('name.dump', tb=tb)
+
+    assert pydump.load_dump('name.dump')['traceback']
+
+
+def test_load_large_uncompressed_dump(tmp_empty, monkeypatch):
+    # dumps created by old versions may not be compressed
+    monkeypatch.setattr(pydump, '_PARALLEL_MIN_SIZE', 0)
+
+    with open('name.dump', 'wb') as f:
+        dill.dump({'x': b'x' * 1024}, f)
+
+    assert pydump.load_dump('name.dump') == {'x': b'x' * 1024}
+
+
+def test_save_dump_larger_than_spool_size(tmp_empty, monkeypatch):
+    # serialize to a temporary file instead of memory
+    monkeypatch.setattr(pydump, '_SPOOL_MAX_SIZE', 1)
+
+    def fn():
+        x = list(range(1000))  # noqa
+        1 / 0
+
+    try:
+        fn()
+    except Exception:
+        tb = sys.exc_info()[2]
+
+    pydump.save_dump('name.dump', tb=tb)
+    dump = pydump.load_dump('name.dump')
+
+    assert dump['traceback'].tb_next.tb_frame.f_locals['x'] == list(
+        range(1000))
+    assert os.listdir() == ['name.dump']
+
+
+def test_save_dump_frame_dictionaries(tmp_empty):
+
+    def inner(shared):
+        # mixes picklable values with one only dill can serialize
+        number = 1  # noqa
+        items = [1, 'two', {'three': 3}]  # noqa
+        square = lambda x: x * x  # noqa
+        1 / 0
+
+    def outer():
+        # only picklable values, pickled as a whole
+        shared = {'key': 'value'}
+        numbers = (1, 2.0)  # noqa
+        inner(shared)
+
+    try:
+        outer()
+    except Exception:
+        tb = sys.exc_info()[2]
+
+    pydump.save_dump('name.dump', tb=tb)
+    dump = pydump.load_dump('name.dump')
+
+    outer_locals = dump['traceback'].tb_next.tb_frame.f_locals
+    inner_locals = dump['traceback'].tb_next.tb_next.tb_frame.f_locals
+
+    assert outer_locals['shared'] == {'key': 'value'}
+    assert outer_locals['numbers'] == (1, 2.0)
+    assert inner_locals['shared'] is outer_locals['shared']
+    assert inner_locals['number'] == 1
+    assert inner_locals['items'] == [1, 'two', {'three': 3}]
+    assert inner_locals['square'](3) == 9
+
+
+def test_save_dump_modules(tmp_empty):
+    Path('script.py').write_text("""
+import os
+import sys
+import threading
+
+from debuglater import pydump
+
+
+def fn():
+    module = os
+    main = sys.modules['__main__']
+    1 / 0
+
+
+try:
+    fn()
+except Exception:
+    pydump.save_dump('script.dump')
+""")
+    subprocess.run([sys.executable, 'script.py'], check=True)
+
+    dump = pydump.load_dump('script.dump')
+    f_locals = dump['traceback'].tb_next.tb_frame.f_locals
+
+    assert f_locals['module'] is os
+    assert f_locals['main'].__name__ == '__main__'
+
+
+def test_save_dump_from_several_threads(tmp_empty):
+
+    def fn(n):
+        square = lambda x: x * x  # noqa
+        number = n  # noqa
+        1 / 0
+
+    def save(n):
+        try:
+            fn(n)
+        except Exception:
+            tb = sys.exc_info()[2]
+
+        barrier.wait()
+        pydump.save_dump(f'{n}.dump', tb=tb)
+
+    barrier = threading.Barrier(8)
+    threads = [threading.Thread(target=save, args=(n, )) for n in range(8)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    for n in range(8):
+        dump = pydump.load_dump(f'{n}.dump')
+        f_locals = dump['traceback'].tb_next.tb_frame.f_locals
+        assert f_locals['square'](3) == 9
+        assert f_locals['number'] == n
+
+
+def test_save_same_dump_from_several_threads(tmp_empty):
+    errors = []
+
+    def save():
+        try:
+            1 / 0
+        except Exception:
+            tb = sys.exc_info()[2]
+
+        barrier.wait()
+
+        try:
+            pydump.save_dump('name.dump', tb=tb)
+        except Exception as e:
+            errors.append(e)
+
+    barrier = threading.Barrier(8)
+    threads = [threading.Thread(target=save) for _ in range(8)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert pydump.load_dump('name.dump')['traceback']
+    assert os.listdir() == ['name.dump']